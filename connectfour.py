@@ -16,6 +16,47 @@ EMPTY = 0
 WHITE = 1
 RED = 2
 
+# The discs of each colour are stored as a bitboard (an int). The cell at
+# (row, column) is bit number column * BITS_PER_COLUMN + row. Each column has
+# one bit more than there are rows; that sentinel bit is never set.
+BITS_PER_COLUMN = ROWS + 1
+
+def _winning_lines():
+    """Return the bitboard masks of all lines of four cells on the grid.
+
+    Returns:
+        Tuple of bitboards (ints), each with the four bits of a horizontal,
+        vertical or diagonal line set.
+    """
+    lines = []
+    for column in range(COLUMNS):
+        for row in range(ROWS):
+            for column_step, row_step in [(1, 0), (0, 1), (1, 1), (1, -1)]:
+                end_column = column + 3 * column_step
+                end_row = row + 3 * row_step
+                if end_column >= COLUMNS or end_row >= ROWS or end_row < 0:
+                    continue
+
+                line = 0
+                for step in range(4):
+                    line |= 1 << ((column + step * column_step) * BITS_PER_COLUMN
+                                  + row + step * row_step)
+                lines.append(line)
+
+    return tuple(lines)
+
+_WINNING_LINES = _winning_lines()
+
+# For each bit number, the winning lines passing through that cell
+CELL_LINES = tuple(tuple(line for line in _WINNING_LINES if line >> bit_number & 1)
+                   for bit_number in range(COLUMNS * BITS_PER_COLUMN))
+
+# State identifiers hold the white bitboard above this many bits of red bitboard
+_IDENTIFIER_SHIFT = COLUMNS * BITS_PER_COLUMN
+
+# Translation table from grid entries to displayable characters
+_DISPLAY_CHARACTERS = bytes.maketrans(bytes([EMPTY, WHITE, RED]), b'.WR')
+
 def other_colour(colour):
     """Return the other of the two colours."""
     if colour == RED:
@@ -25,33 +66,20 @@ def other_colour(colour):
     else:
         raise ValueError('Unrecognised colour: {}'.format(colour))   
 
-def _entry_to_character(entry):
-    """Convert grid entry (cell) to displayable character.
-
-    Args:
-        entry: One of EMPTY, WHITE and RED
-
-    Returns:
-        Single character used for display purposes
-    """
-    if entry == EMPTY:
-        return '.'
-    elif entry == WHITE:
-        return 'W'
-    elif entry == RED:
-        return 'R'
-    else:
-        raise ValueError('Unknown grid entry')
-
 class ConnectFour:
     """The grid for the game 'Connect Four'. Implements rules and moves.
     """
 
+    __slots__ = ('_white', '_red', '_heights', '_legal_moves', '_winner')
+
     def __init__(self):
         """Init ConnectFour()"""
 
-        # Position (0, 0) is interpreted as lower left. Discs are dropped from the top.
-        self._grid = np.full((ROWS, COLUMNS), EMPTY, dtype='i1')
+        # Row 0 is interpreted as the bottom row. Discs are dropped from the top.
+        self._white = 0
+        self._red = 0
+        self._heights = [0] * COLUMNS # Number of discs in each column
+        self._legal_moves = list(range(COLUMNS)) # Columns that are not full
         self._winner = None
 
     def legal_moves(self):
@@ -61,7 +89,8 @@ class ConnectFour:
             List of columns with room for at least one more disc
         """
 
-        return [col for col in range(COLUMNS) if self._grid[ROWS-1, col] == EMPTY]
+        # Copied so callers cannot change our list
+        return self._legal_moves[:]
 
     def add_disc(self, column, colour):
         """Add disc to game grid
@@ -73,72 +102,67 @@ class ConnectFour:
         Returns:
             None
         """
-        for row in range(ROWS):
-            if self._grid[row, column] == EMPTY:
-                self._grid[row, column] = colour
-                if self._check_winner_at_location(row, column):
-                    self._winner = colour
-                break
-        else:
+        if not 0 <= column < COLUMNS:
             raise IllegalMove
 
-    def state_identifier(self):
-        """Return hashable identifier
+        heights = self._heights
+        row = heights[column]
+        if row == ROWS:
+            raise IllegalMove
 
-        Returns:
-            A hashable identifier for the state of the grid.
-        """
+        bit_number = column * BITS_PER_COLUMN + row
+        if colour == WHITE:
+            bitboard = self._white = self._white | 1 << bit_number
+        elif colour == RED:
+            bitboard = self._red = self._red | 1 << bit_number
+        else:
+            raise ValueError('Unhandled colour: {}'.format(colour))
 
-        column_identifiers = []
+        heights[column] = row + 1
+        if row + 1 == ROWS:
+            self._legal_moves.remove(column)
 
-        for column in range(COLUMNS):
-            column_identifier = 0
-            row_multiplier = 1
-            for colour in self._grid[:, column]:
-                if colour == WHITE:
-                    column_identifier += 2 * row_multiplier
-                elif colour == RED:
-                    column_identifier += row_multiplier
-                else:
-                    break
-                row_multiplier *= 3
-            column_identifiers.append(column_identifier)
+        # Only lines through the new disc can have been completed by it
+        for line in CELL_LINES[bit_number]:
+            if bitboard & line == line:
+                self._winner = colour
+                break
 
-        identifier = tuple(column_identifiers)
+    def state_identifier(self):
+        """Return hashable identifier
 
-        return identifier
+        Returns:
+            An identifier (int) for the state of the grid. Different states
+            have different identifiers. Being a plain int, it is cheap to use
+            as a dictionary key.
+        """
+        # The two bitboards together are the state, so they make the identifier
+        return self._white << _IDENTIFIER_SHIFT | self._red
 
     def next_state_identifier(self, column, colour):
         """Return hashable identifier for the state following the specified move.
 
         Returns:
-            Hashable identifier of the state that follows from the current grid state
+            Identifier (int) of the state that follows from the current grid state
                 if a disc of the specified colour is dropped into the specified
-                column
+                column. It equals what state_identifier returns after that move.
         """
 
-        # TODO: Ensure consistency between this method and state_identifier
+        if not 0 <= column < COLUMNS:
+            raise IllegalMove
 
-        for row in range(ROWS):
-            if self._grid[row, column] == EMPTY:
-                break
-        else:
+        row = self._heights[column]
+        if row == ROWS:
             raise IllegalMove
 
-        identifier = self.state_identifier()
+        bit = 1 << (column * BITS_PER_COLUMN + row)
         if colour == WHITE:
-            additional_identifier = 2 * 3**row
+            return (self._white | bit) << _IDENTIFIER_SHIFT | self._red
         elif colour == RED:
-            additional_identifier = 3**row
+            return self._white << _IDENTIFIER_SHIFT | self._red | bit
         else:
             raise ValueError('Unhandled colour')
 
-        identifier = list(identifier)
-        identifier[column] += additional_identifier
-        identifier = tuple(identifier)
-
-        return identifier
-
     def winner(self):
         """Return (colour of) winner of the game
 
@@ -148,52 +172,61 @@ class ConnectFour:
         """
         return self._winner
 
-    def grid_copy(self):
-        """Return copy of the game grid.
+    def bitboards(self):
+        """Return the bitboards of the two colours.
 
         Returns:
-            game grid as np.array (matrix of size ROWS x COLUMNS). Entries in
-            matrix are RED, WHITE and EMPTY. Lower left is (0,0).
+            Tuple (white, red) of ints. The cell at (row, column) holds a disc
+            of a colour if bit number column * BITS_PER_COLUMN + row is set in
+            the bitboard of that colour. Bit number column * BITS_PER_COLUMN +
+            ROWS is never set.
         """
-        return self._grid.copy()
+        return self._white, self._red
+
+    def clone(self):
+        """Return an independent copy of the game.
 
-    def _check_winner_at_location(self, row, column):
-        """Check whether there are 4 in a row involving the disc at the
-        specified location.
+        Much cheaper than grid_copy as no grid is unpacked, so this is the
+        one to use when exploring moves.
 
         Returns:
-            Boolean indicating whether the specified location is part of
-            four in a row.
+            ConnectFour() in the same state as this one
         """
+        game = ConnectFour.__new__(ConnectFour)
+        game._white = self._white
+        game._red = self._red
+        game._heights = self._heights[:]
+        game._legal_moves = self._legal_moves[:]
+        game._winner = self._winner
+        return game
 
-        colour_at_location = self._grid[row, column]
-        if colour_at_location == EMPTY:
-            return False
-
-        for x_jump, y_jump in [(1, 0), (0, 1), (1, 1), (1, -1)]:
-            same_colour_in_sequence_count = 1
-            for direction in [1, -1]:
-                x_pos, y_pos = row, column
-                x_jump *= direction
-                y_jump *= direction
-
-                while True:
-                    x_pos += x_jump
-                    y_pos += y_jump
+    def grid_copy(self):
+        """Return copy of the game grid.
 
-                    if x_pos >= ROWS or x_pos < 0 or y_pos >= COLUMNS or y_pos < 0:
-                        break
+        Returns:
+            game grid as np.array (matrix of size ROWS x COLUMNS). Entries in
+            matrix are RED, WHITE and EMPTY. Lower left is (0,0).
+        """
+        # The bytearray is owned by the returned matrix only, so no copy is needed
+        return np.frombuffer(self._cells(), dtype='i1').reshape(ROWS, COLUMNS)
 
-                    if self._grid[x_pos, y_pos] == colour_at_location:
-                        same_colour_in_sequence_count += 1
-                    else:
-                        break
+    def _cells(self):
+        """Return the grid unpacked from the bitboards.
 
-            if same_colour_in_sequence_count >= 4:
-                return True
+        Returns:
+            bytearray of length ROWS * COLUMNS. The entry of cell (row, column)
+            is at index row * COLUMNS + column and is RED, WHITE or EMPTY.
+        """
+        cells = bytearray(ROWS * COLUMNS)
+        for column, height in enumerate(self._heights):
+            # Cells above the column height are empty, so are left untouched
+            for row in range(height):
+                if self._white >> (column * BITS_PER_COLUMN + row) & 1:
+                    cells[row * COLUMNS + column] = WHITE
+                else:
+                    cells[row * COLUMNS + column] = RED
 
-        # If we have made it here, it means no winning condition is satisfied
-        return False
+        return cells
 
     def __str__(self):
         """Grid as string
@@ -201,9 +234,8 @@ class ConnectFour:
         Returns:
             The game grid as a string
         """
-        lines = []
-        for row in range(ROWS-1, -1, -1):
-            lines.append(''.join(map(_entry_to_character, self._grid[row, :])))
+        text = self._cells().translate(_DISPLAY_CHARACTERS).decode()
+        lines = [text[row*COLUMNS:(row+1)*COLUMNS] for row in range(ROWS-1, -1, -1)]
 
         return '\n'.join(lines)
 
@@ -297,6 +329,34 @@ def test_diagonal_winner():
     game.add_disc(COLUMNS - moves[-1][0] - 1, moves[-1][1])
     assert game.winner() is WHITE
 
+def test_edge_winner():
+    """Test win detection at the edges of the grid.
+
+    We fill out the following position:
+
+    W.....W
+    W.....W
+    R.....W
+    W.....W
+    RW....R
+    WW....R
+
+    The vertical line in the right column touches the top edge. In the left
+    columns the two white discs at the top of column 0 and the two at the
+    bottom of column 1 must not be counted as a line.
+    """
+    moves = [(0, WHITE), (0, RED), (0, WHITE), (0, RED), (0, WHITE), (0, WHITE),
+             (1, WHITE), (1, WHITE), (6, RED), (6, RED), (6, WHITE), (6, WHITE),
+             (6, WHITE)]
+
+    game = ConnectFour()
+    for column, colour in moves:
+        game.add_disc(column, colour)
+        assert game.winner() is None
+
+    game.add_disc(6, WHITE)
+    assert game.winner() is WHITE
+
 def test_simple_example_1():
     """Check some locations in example game grid.
 
@@ -365,6 +425,7 @@ def test_simple():
         game.add_disc(column, disc_colour)
 
         state_id = game.state_identifier()
+        assert type(state_id) is int
         assert state_id != last_state_id
         assert next_state_id == state_id
         last_state_id = state_id
@@ -389,14 +450,37 @@ def test_simple():
 
     assert game.legal_moves() == [column for column in range(COLUMNS) if column != 3]
 
+def test_clone():
+    """Test that a cloned game is equal to but independent of the original."""
+    game = ConnectFour()
+    for column, colour in [(3, WHITE), (3, RED), (4, WHITE), (2, RED), (5, WHITE)]:
+        game.add_disc(column, colour)
+
+    clone = game.clone()
+    assert clone.state_identifier() == game.state_identifier()
+    assert str(clone) == str(game)
+
+    assert clone.bitboards() == game.bitboards()
+
+    clone.add_disc(6, WHITE)
+    assert clone.winner() == WHITE
+    assert game.winner() is None
+    assert clone.state_identifier() != game.state_identifier()
+    assert game.legal_moves() == clone.legal_moves()
+
+    game.add_disc(6, RED)
+    assert str(clone) != str(game)
+
 def test():
     """Execute full test suite"""
     test_horizontal_winner()
     test_vertical_winner()
     test_diagonal_winner()
+    test_edge_winner()
     test_simple()
     test_simple_example_1()
     test_simple_example_2()
+    test_clone()
 
 if __name__ == '__main__':
     test()
@@ -3,8 +3,10 @@
 Classes:
     ConnectFourMatch
 """
+import random
 import connectfour
 import connectfourplayers
+import connectfourselfplay
 
 REWARD_DRAW = 0
 REWARD_LEGAL_MOVE = 0
@@ -12,10 +14,17 @@ REWARD_ILLEGAL_MOVE = -2
 REWARD_LOSS = -1
 REWARD_WIN = 1
 
+# The earliest move that can win is the fourth disc of white (move number 6)
+_FIRST_WINNING_MOVE_NUMBER = 6
+
+_MAX_NUMBER_OF_MOVES = connectfour.ROWS * connectfour.COLUMNS
+
 class ConnectFourMatch:
     """Implements the architecture around a Connect Four match.
     """
 
+    __slots__ = ('_player_white', '_player_red', '_is_random_match')
+
     def __init__(self, player_white, player_red):
         """Init ConnectFourMatch() with players.
 
@@ -28,6 +37,8 @@ class ConnectFourMatch:
         self._player_white = player_white
         self._player_red = player_red
 
+        self._is_random_match = connectfourselfplay.is_random_match(player_white, player_red)
+
     def play(self, verbose=False):
         """Play match of Connect Four. Return colour of winner.
 
@@ -39,24 +50,44 @@ class ConnectFourMatch:
             Colour of winner (connectfour -> RED/WHITE) or None in case of draw.
         """
 
-        max_number_of_moves = connectfour.ROWS * connectfour.COLUMNS
-        players = ((self._player_white, connectfour.WHITE), (self._player_red, connectfour.RED))
-        game_grid = connectfour.ConnectFour()
-
-        for move_number in range(max_number_of_moves):
-            current_player, current_colour = players[move_number%2]
-            other_player, other_colour = players[(move_number+1)%2]
+        if self._is_random_match and not verbose:
+            return connectfourselfplay.play_random_match()
 
+        last_move_number = _MAX_NUMBER_OF_MOVES - 1
+        game_grid = connectfour.ConnectFour()
+        add_disc = game_grid.add_disc
+        winner = game_grid.winner
+        illegal_move = connectfour.IllegalMove
+
+        # The first move cannot win or end the game, and red has not moved yet,
+        # so only an illegal move needs handling. Red is not rewarded, to
+        # preserve the contract that we always call propose_move and
+        # receive_reward in that order.
+        move = self._player_white.propose_move(game_grid)
+        try:
+            add_disc(move, connectfour.WHITE)
+        except illegal_move:
+            self._player_white.receive_reward(REWARD_ILLEGAL_MOVE)
+
+            if verbose:
+                print('Bad move: {}'.format(move))
+                print('Winner is {}'.format(connectfour.RED))
+                print(game_grid)
+
+            return connectfour.RED
+
+        # The players swap roles at the end of every move
+        current_player, current_colour = self._player_red, connectfour.RED
+        other_player, other_colour = self._player_white, connectfour.WHITE
+
+        for move_number in range(1, _MAX_NUMBER_OF_MOVES):
             move = current_player.propose_move(game_grid)
 
             try:
-                game_grid.add_disc(move, current_colour)
-            except connectfour.IllegalMove:
+                add_disc(move, current_colour)
+            except illegal_move:
                 current_player.receive_reward(REWARD_ILLEGAL_MOVE)
-                # Only reward a player if he has moved to preserve the contract that
-                # we always call propose_move and receive_reward in that order
-                if move_number > 0:
-                    other_player.receive_reward(REWARD_WIN)
+                other_player.receive_reward(REWARD_WIN)
 
                 if verbose:
                     print('Bad move: {}'.format(move))
@@ -65,7 +96,7 @@ class ConnectFourMatch:
 
                 return other_colour
 
-            if game_grid.winner() is not None:
+            if move_number >= _FIRST_WINNING_MOVE_NUMBER and winner() is not None:
                 current_player.receive_reward(REWARD_WIN)
                 other_player.receive_reward(REWARD_LOSS)
 
@@ -76,7 +107,7 @@ class ConnectFourMatch:
                 return current_colour
             else:
                 # If this is the last move of the game, we have a draw
-                if move_number == max_number_of_moves - 1:
+                if move_number == last_move_number:
                     current_player.receive_reward(REWARD_DRAW)
                     other_player.receive_reward(REWARD_DRAW)
                     if verbose:
@@ -85,8 +116,10 @@ class ConnectFourMatch:
                     return None
                 # Otherwise the other player is simply rewarded with REWARD_LEGAL_MOVE
                 else:
-                    if move_number > 0:
-                        other_player.receive_reward(REWARD_LEGAL_MOVE)
+                    other_player.receive_reward(REWARD_LEGAL_MOVE)
+
+            current_player, other_player = other_player, current_player
+            current_colour, other_colour = other_colour, current_colour
 
         # Note that we should never reach this line (if we do the code is wrong)
 
@@ -95,6 +128,21 @@ def test_random_players():
     match = ConnectFourMatch(connectfourplayers.RandomPlayer(), connectfourplayers.RandomPlayer())
     match.play()
 
+def test_random_match_shortcut():
+    """Test that random players get the same results with and without the shortcut"""
+    class SubclassedRandomPlayer(connectfourplayers.RandomPlayer):
+        """On the fly class that is not special-cased by ConnectFourMatch"""
+
+    shortcut_match = ConnectFourMatch(connectfourplayers.RandomPlayer(),
+                                      connectfourplayers.RandomPlayer())
+    full_match = ConnectFourMatch(SubclassedRandomPlayer(), SubclassedRandomPlayer())
+
+    random.seed(1)
+    shortcut_winners = [shortcut_match.play() for _ in range(100)]
+    random.seed(1)
+    full_winners = [full_match.play() for _ in range(100)]
+    assert shortcut_winners == full_winners
+
 def test_method_call_sequence():
     """Test whether propose_move and receive_reward are called in alternating sequence.
 
@@ -137,6 +185,7 @@ def test_method_call_sequence():
 def test():
     """Execute full test suite"""
     test_random_players()
+    test_random_match_shortcut()
     test_method_call_sequence()
 
 if __name__ == '__main__':
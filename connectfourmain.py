@@ -3,27 +3,114 @@
 This contains the code for interacting with the user.
 """
 
+import concurrent.futures
+import random
+import connectfour
 import connectfourgame
 import connectfourplayers
+import connectfourselfplay
 
-def train_players(player_white, player_red, number_of_matches):
+# Number of matches between random players played at once
+RANDOM_MATCH_BATCH_SIZE = 1000
+
+def train_players(player_white, player_red, number_of_matches, number_of_workers=1):
     """Play specified number of matches between player_white and player_red
 
+    With more than one worker, the matches are split between that many
+    processes, each playing copies of the two players. Afterwards the copies
+    are merged back into the players. This requires both players to implement
+    merge_trained_copies (see connectfourplayers); otherwise the matches are
+    played in this process.
+
     Args:
         player_white: The player object playing white (goes first)
         player_red: The player object playing red
         number_of_matches: Number of matches to play
+        number_of_workers: Number of processes to play the matches in
 
     Returns:
         None
     """
 
+    # Matches between random players are played in batches without the players
+    if connectfourselfplay.is_random_match(player_white, player_red):
+        matches_played = 0
+        while matches_played < number_of_matches:
+            batch_size = min(RANDOM_MATCH_BATCH_SIZE, number_of_matches - matches_played)
+            winners = connectfourselfplay.play_random_matches(batch_size)
+            matches_played += batch_size
+            print('Has trained {} times (white won {}, red won {}, {} draws)'.format(
+                matches_played, (winners == connectfour.WHITE).sum(),
+                (winners == connectfour.RED).sum(), (winners == connectfour.EMPTY).sum()))
+        return
+
+    if (number_of_workers > 1 and hasattr(player_white, 'merge_trained_copies')
+            and hasattr(player_red, 'merge_trained_copies')):
+        _train_players_in_parallel(player_white, player_red, number_of_matches,
+                                   number_of_workers)
+        return
+
     match = connectfourgame.ConnectFourMatch(player_white, player_red)
     for match_count in range(1, number_of_matches+1):
         match.play()
         if match_count%100 == 0:
             print('Has trained {} times'.format(match_count))
 
+def _play_matches(player_white, player_red, number_of_matches, seed):
+    """Play matches between the players. Run in worker processes.
+
+    Args:
+        player_white: The player object playing white (goes first)
+        player_red: The player object playing red
+        number_of_matches: Number of matches to play
+        seed: Seed for the random moves, so that workers forked from the
+            same process do not all explore alike
+
+    Returns:
+        Tuple of the two (trained) players and the number of matches played
+    """
+    random.seed(seed)
+    match = connectfourgame.ConnectFourMatch(player_white, player_red)
+    for _match_count in range(number_of_matches):
+        match.play()
+
+    return player_white, player_red, number_of_matches
+
+def _train_players_in_parallel(player_white, player_red, number_of_matches, number_of_workers):
+    """Train copies of the players in worker processes and merge them back.
+
+    Args:
+        player_white: The player object playing white (goes first)
+        player_red: The player object playing red
+        number_of_matches: Total number of matches to play
+        number_of_workers: Number of processes to play the matches in
+
+    Returns:
+        None
+    """
+    shares = [number_of_matches // number_of_workers
+              + (1 if worker < number_of_matches % number_of_workers else 0)
+              for worker in range(number_of_workers)]
+
+    trained_whites = []
+    trained_reds = []
+    match_count = 0
+    with concurrent.futures.ProcessPoolExecutor(number_of_workers) as executor:
+        # Each worker gets its own (pickled) copies of the players, without
+        # their caches
+        futures = [executor.submit(_play_matches, player_white, player_red, share,
+                                   random.getrandbits(32))
+                   for share in shares if share > 0]
+        for future in concurrent.futures.as_completed(futures):
+            trained_white, trained_red, share = future.result()
+            trained_whites.append(trained_white)
+            trained_reds.append(trained_red)
+            match_count += share
+            print('Has trained {} times'.format(match_count))
+
+    player_white.merge_trained_copies(trained_whites)
+    player_red.merge_trained_copies(trained_reds)
+
 def choose_player():
     """Ask user to choose a player object.
 
@@ -55,7 +142,8 @@ def main():
     print('RED PLAYER')
     player_red = choose_player()
     num_training_matches = int(input('How many training matches?'))
-    train_players(player_white, player_red, num_training_matches)
+    number_of_workers = int(input('How many processes to train in?') or 1)
+    train_players(player_white, player_red, num_training_matches, number_of_workers)
 
     while True:
         human_player = connectfourplayers.HumanPlayer()
@@ -69,4 +157,23 @@ def main():
         if not continue_playing == 'Y':
             break
 
-main()
+def test_train_players_in_parallel():
+    """Test training copies of the players in two worker processes"""
+    player_white = connectfourplayers.SimpleFeaturePlayer()
+    player_red = connectfourplayers.AdvancedFeaturePlayer()
+    white_parameters = player_white._parameter_vector().copy()
+    red_parameters = player_red._parameter_vector().copy()
+
+    train_players(player_white, player_red, 60, number_of_workers=2)
+
+    # The merged players have learned, and can still play
+    assert not (player_white._parameter_vector() == white_parameters).all()
+    assert not (player_red._parameter_vector() == red_parameters).all()
+    connectfourgame.ConnectFourMatch(player_white, player_red).play()
+
+def test():
+    """Execute all tests for this module"""
+    test_train_players_in_parallel()
+
+if __name__ == '__main__':
+    main()
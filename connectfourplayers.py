@@ -14,6 +14,13 @@ A player class must implement the following methods:
     receive_reward(self, reward):
         reward: integer signifying reward for last move (the higher the better)
 
+A player class may implement the following method to support training in
+parallel processes:
+    merge_trained_copies(self, copies):
+        copies: copies of this player, each trained on its own matches
+
+        Must take over what the copies have learned.
+
 Classes:
     RandomPlayer: Makes random but always legal moves.
     HumanPlayer: Takes input from user when deciding on move.
@@ -26,6 +33,42 @@ import numpy as np
 import connectfour
 import connectfourutils
 
+# Number of grids whose features a player remembers
+FEATURE_CACHE_SIZE = 200000
+
+class _LeastRecentlyUsedCache:
+    """A dict of limited size, dropping the least recently used entries first."""
+
+    def __init__(self, size):
+        """Init _LeastRecentlyUsedCache()
+
+        Args:
+            size: The maximum number of entries
+        """
+        self._size = size
+        # Dicts keep insertion order, so the least recently used entry is first
+        self._entries = {}
+
+    def get(self, key):
+        """Return the value for key (None if there is none) and mark it as used."""
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """Store value for key, dropping the least recently used entry if full."""
+        if key not in self._entries and len(self._entries) >= self._size:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = value
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
 class RandomPlayer:
     """A player making a random legal move each turn."""
 
@@ -104,11 +147,13 @@ class HumanPlayer:
 class AfterStatePlayer:
     """A base class for players using function approximation on state values.
 
+    State values are linear in the features: the dot product of the feature
+    vector and the parameter vector.
+
     Subclasses must override:
-        _state_value:
+        _compute_features:
         _parameter_vector:
         _set_parameter_vector:
-        _nabla_parameter_vector:
     """
 
     def __init__(self):
@@ -123,12 +168,35 @@ class AfterStatePlayer:
         self._last_afterstate_matrix = None
         self._last_afterstate_value = None
 
+        # Features depend only on the grid and this player's colour, so they
+        # are remembered by grid, see _cached_features
+        self._feature_cache = _LeastRecentlyUsedCache(FEATURE_CACHE_SIZE)
+
+        # The grid as last seen by this player, see _observe_grid
+        self._grid_matrix = np.full((connectfour.ROWS, connectfour.COLUMNS), connectfour.EMPTY, dtype='i1')
+        self._grid_bitboards = (0, 0)
+
+    def __getstate__(self):
+        """Return the state to pickle, leaving out the feature cache.
+
+        The cache can hold hundreds of thousands of entries and is rebuilt as
+        needed, so copies such as those trained in worker processes (see
+        merge_trained_copies) start and come back without it.
+        """
+        state = self.__dict__.copy()
+        state['_feature_cache'] = _LeastRecentlyUsedCache(FEATURE_CACHE_SIZE)
+        return state
+
     def set_player_colour(self, player_colour):
         """Register the colour of this player's discs
 
         Args:
             player_colour: Either RED or WHITE as defined in connectfour.py
         """
+        # Every match sets the colour, but only a new colour changes the
+        # features remembered
+        if player_colour != self._player_colour:
+            self._feature_cache.clear()
         self._player_colour = player_colour
 
     def propose_move(self, game_grid):
@@ -143,7 +211,9 @@ class AfterStatePlayer:
         """
 
         potential_moves = game_grid.legal_moves()
-        grid_matrix = game_grid.grid_copy()
+        grid_matrix = self._observe_grid(game_grid)
+        # The row a disc added to a column lands in
+        heights = (grid_matrix != connectfour.EMPTY).sum(axis=0).tolist()
 
         if self._is_learning and random.random() < self._epsilon:
             chosen_move = random.choice(potential_moves)
@@ -153,42 +223,57 @@ class AfterStatePlayer:
             self._last_afterstate_matrix = None
 
             # As it is guaranteed to be a legal move, we don't need exception protection.
-            for row in range(connectfour.ROWS):
-                if grid_matrix[row, chosen_move] == connectfour.EMPTY:
-                    grid_matrix[row, chosen_move] = self._player_colour
-                    break
+            afterstate_matrix = grid_matrix.copy()
+            afterstate_matrix[heights[chosen_move], chosen_move] = self._player_colour
 
-            self._next_afterstate_value = self._state_value(grid_matrix)
-            self._next_afterstate_matrix = grid_matrix
+            self._next_afterstate_value = self._state_value(afterstate_matrix)
+            self._next_afterstate_matrix = afterstate_matrix
         else:
-            best_afterstate_matrix = None
-            best_afterstate_value = - np.inf
-
-            for proposed_move in potential_moves:
-                # As it is guaranteed to be a legal move, we don't need exception protection.
-                for row in range(connectfour.ROWS):
-                    if grid_matrix[row, proposed_move] == connectfour.EMPTY:
-                        grid_matrix[row, proposed_move] = self._player_colour
-                        break
+            afterstate_values = self._afterstate_values(grid_matrix, heights, potential_moves)
+            # Ties go to the first of the best moves
+            best_index = int(np.argmax(afterstate_values))
+            chosen_move = potential_moves[best_index]
+            best_afterstate_value = afterstate_values[best_index]
 
-                afterstate_value = self._state_value(grid_matrix)
-                if afterstate_value > best_afterstate_value:
-                    best_afterstate_value = afterstate_value
-                    best_afterstate_matrix = grid_matrix.copy()
-                    chosen_move = proposed_move
-
-                # Back to original state
-                grid_matrix[row, proposed_move] = connectfour.EMPTY
-
-            # At this point we are guaranteed to have a best_afterstate_matrix
-            # as propose_move is contractually only called when there are legal
-            # moves available.
+            best_afterstate_matrix = grid_matrix.copy()
+            best_afterstate_matrix[heights[chosen_move], chosen_move] = self._player_colour
 
             self._next_afterstate_value = best_afterstate_value
             self._next_afterstate_matrix = best_afterstate_matrix
 
         return chosen_move
 
+    def _observe_grid(self, game_grid):
+        """Bring this player's grid matrix up to date with game_grid.
+
+        Only the discs added since the last call are copied into the matrix,
+        unless game_grid does not continue the grid seen then (as in a new
+        match). This saves copying the whole grid every move.
+
+        Args:
+            game_grid: ConnectFour() game_grid with current position
+
+        Returns:
+            The grid as matrix (np.array). It is reused by later calls, so it
+            must be copied to be kept and restored after changes.
+        """
+        white, red = game_grid.bitboards()
+        seen_white, seen_red = self._grid_bitboards
+        if seen_white & ~white or seen_red & ~red:
+            self._grid_matrix = game_grid.grid_copy()
+        else:
+            for colour, new_discs in [(connectfour.WHITE, white & ~seen_white),
+                                      (connectfour.RED, red & ~seen_red)]:
+                while new_discs:
+                    bit_number = (new_discs & -new_discs).bit_length() - 1
+                    # Bit numbers are laid out as in ConnectFour.bitboards
+                    column, row = divmod(bit_number, connectfour.BITS_PER_COLUMN)
+                    self._grid_matrix[row, column] = colour
+                    new_discs &= new_discs - 1
+
+        self._grid_bitboards = (white, red)
+        return self._grid_matrix
+
     def receive_reward(self, reward):
         """Record the reward for the last move.
 
@@ -216,6 +301,17 @@ class AfterStatePlayer:
         self._last_afterstate_value = self._next_afterstate_value
         self._last_afterstate_matrix = self._next_afterstate_matrix
 
+    def merge_trained_copies(self, copies):
+        """Take over what copies of this player have learned.
+
+        The parameter vector becomes the average of those of the copies.
+
+        Args:
+            copies: List of copies of this player, each trained on its own matches
+        """
+        parameter_vectors = [player_copy._parameter_vector() for player_copy in copies]
+        self._set_parameter_vector(np.mean(parameter_vectors, axis=0))
+
     def set_learning_state(self, is_on):
         """Toggle learning and exploration on and off.
 
@@ -225,13 +321,33 @@ class AfterStatePlayer:
         """
         self._is_learning = is_on
 
-    def _state_value(self, grid_matrix):
-        """The estimated value of the given state matrix.
+    def _afterstate_values(self, grid_matrix, heights, moves):
+        """The estimated values of the afterstates of the given moves.
+
+        State values are linear in the features (see _compute_features), so
+        all the afterstates are valued by one matrix product.
 
-        This should depend on self._parameter_vector and be in sync with
-        self._nabla_parameter_vector().
+        Args:
+            grid_matrix (np.array): The Connect Four grid as a matrix before the move.
+                It is changed while valuing, but restored on return.
+            heights (list): The row a disc added to each column lands in
+            moves (list): The columns to add a disc of this player's colour to
 
-        MUST BE OVERRIDEN IN SUBCLASSES.
+        Returns:
+            np.array of the estimated values of the afterstates, one per move.
+        """
+        parameter_vector = self._parameter_vector()
+        feature_matrix = np.empty((len(moves), parameter_vector.size))
+        for index, move in enumerate(moves):
+            row = heights[move]
+            grid_matrix[row, move] = self._player_colour
+            feature_matrix[index] = self._cached_features(grid_matrix)
+            grid_matrix[row, move] = connectfour.EMPTY
+
+        return np.dot(feature_matrix, parameter_vector)
+
+    def _state_value(self, grid_matrix):
+        """The estimated value of the given state matrix.
 
         Args:
             grid_matrix (np.array): The Connect Four grid as a matrix (as defined in connectfour.py)
@@ -239,7 +355,7 @@ class AfterStatePlayer:
         Returns:
             Estimated value of the state corresponding to the input matrix.
         """
-        pass
+        return np.dot(self._cached_features(grid_matrix), self._parameter_vector())
 
     def _parameter_vector(self):
         """Return the parameter vector.
@@ -262,11 +378,45 @@ class AfterStatePlayer:
         """
         pass
 
+    def _cached_features(self, grid_matrix):
+        """Return the feature vector of a grid, computing it only if not remembered.
+
+        Args:
+            grid_matrix (np.array): The game grid as matrix
+
+        Returns:
+            Vector (np.array) of the feature values, see _compute_features. It
+            is shared between callers, so it is read-only.
+        """
+        key = grid_matrix.tobytes()
+        features = self._feature_cache.get(key)
+        if features is None:
+            features = self._compute_features(grid_matrix)
+            features.flags.writeable = False
+            self._feature_cache.put(key, features)
+
+        return features
+
+    def _compute_features(self, grid_matrix):
+        """Return feature vector.
+
+        This must depend only on grid_matrix and the player's colour.
+
+        MUST BE OVERRIDDEN IN SUBCLASS.
+
+        Args:
+            grid_matrix (np.array): The game grid as matrix
+
+        Returns:
+            Vector (np.array) of the feature values
+        """
+        pass
+
     def _nabla_parameter_vector(self, grid_matrix):
         """Nabla of state value func with respect to parameter vector in the
         state defined by grid_matrix.
 
-        MUST BE OVERRIDDEN IN SUBCLASS
+        State values are linear, so this is the feature vector.
 
         Args:
             grid_matrix (np.array): The state point in which to calculate nabla.
@@ -274,7 +424,7 @@ class AfterStatePlayer:
         Returns:
             np.array. Nabla of state grid_matrix with respect to parameter vector.
         """
-        pass
+        return self._cached_features(grid_matrix)
 
 class SimpleFeaturePlayer(AfterStatePlayer):
     """Player using linear value approximation"""
@@ -293,7 +443,7 @@ class SimpleFeaturePlayer(AfterStatePlayer):
         self._other_colour = connectfour.other_colour(colour)
         return super().set_player_colour(colour)
 
-    def _features(self, grid_matrix):
+    def _compute_features(self, grid_matrix):
         """Return feature vector.
 
         Args:
@@ -305,24 +455,10 @@ class SimpleFeaturePlayer(AfterStatePlayer):
         # As features we use how many lines there are on the board containing N discs of
         # our colour and none of the other player's colour (N=1,...,4).
         # Also include those 4 numbers from the opponent's perspective.
-        our_openings = connectfourutils.count_open_positions(grid_matrix, self._player_colour)[1:]
-        opponents_openings = connectfourutils.count_open_positions(grid_matrix, self._other_colour)[1:]
-
-        return np.concatenate([our_openings, opponents_openings])
+        our_openings, opponents_openings = connectfourutils.count_open_positions_both(
+            grid_matrix, self._player_colour)
 
-    def _state_value(self, grid_matrix):
-        """The estimated value of the given state matrix.
-
-
-        Args:
-            grid_matrix (np.array): The Connect Four grid as a matrix (as defined in connectfour.py)
-
-        Returns:
-            Estimated value of the state corresponding to the input matrix.
-        """
-        features = self._features(grid_matrix)
-        parameter_vector = self._parameter_vector()
-        return np.dot(features, parameter_vector)
+        return np.concatenate([our_openings[1:], opponents_openings[1:]])
 
     def _parameter_vector(self):
         """Return the parameter vector.
@@ -341,30 +477,28 @@ class SimpleFeaturePlayer(AfterStatePlayer):
         """
         self._parameters = new_vector
 
-    def _nabla_parameter_vector(self, grid_matrix):
-        """Nabla of state value func with respect to parameter vector in the
-        state defined by grid_matrix.
-
-        Args:
-            grid_matrix (np.array): The state point in which to calculate nabla.
-
-        Returns:
-            np.array. Nabla of state grid_matrix with respect to parameter vector.
-        """
-        return self._features(grid_matrix)
-
 class AdvancedFeaturePlayer(AfterStatePlayer):
     """Playing using linear function approximation and experience replay"""
 
+    # Scales the features (see _compute_features) so each has a magnitude of about 1
+    _FEATURE_MULTIPLIER = np.tile([0.05, 0.2, 0.8, 1], 2)
+
     def __init__(self):
         super().__init__()
         self._other_colour = None
         self._number_experiences_remembered = 1000
         self._episode_size = 100
         self._learning_frequency = 100
-        self._experiences = []
         self._parameters = np.concatenate([np.random.rand(4), -np.random.rand(4)])
 
+        # The experiences remembered are kept in ring buffers: the features of
+        # the afterstates before and after each transition and its reward.
+        # Experience number n is in slot n % _number_experiences_remembered.
+        self._number_experiences = 0
+        self._last_features = np.empty((self._number_experiences_remembered, self._parameters.size))
+        self._next_features = np.empty((self._number_experiences_remembered, self._parameters.size))
+        self._rewards = np.empty(self._number_experiences_remembered)
+
     def set_player_colour(self, colour):
         """Register the colour of the player."""
         self._other_colour = connectfour.other_colour(colour)
@@ -378,38 +512,42 @@ class AdvancedFeaturePlayer(AfterStatePlayer):
         """
 
         if self._last_afterstate_matrix is not None:
-            self._experiences.append((self._last_afterstate_matrix, self._next_afterstate_matrix, reward))
+            slot = self._number_experiences % self._number_experiences_remembered
+            self._last_features[slot] = self._cached_features(self._last_afterstate_matrix)
+            self._next_features[slot] = self._cached_features(self._next_afterstate_matrix)
+            self._rewards[slot] = reward
+            self._number_experiences += 1
 
         # Update the parameters for the self._last_afterstate_matrix state
         # unless we are explicitly not learning or it's the reward after the
         # first move in which case there is no previous afterstate.
 
-        if self._is_learning and len(self._experiences)%self._learning_frequency == 0 and len(self._experiences) != 0:
-            if len(self._experiences) > self._number_experiences_remembered:
-                self._experiences = self._experiences[-self._number_experiences_remembered:]
+        if (self._is_learning and self._number_experiences%self._learning_frequency == 0
+                and self._number_experiences != 0):
+            number_remembered = min(self._number_experiences, self._number_experiences_remembered)
+            oldest_slot = (self._number_experiences - number_remembered) % self._number_experiences_remembered
 
-            episode_experiences = random.sample(self._experiences, min(self._episode_size, len(self._experiences)))
-
-            feature_matrix = []
-            target_values = []
-            for last_matrix, next_matrix, reward in episode_experiences:
-                target_values.append(self._state_value(next_matrix)+reward)
-                feature_matrix.append(self._features(last_matrix))
-
-            target_values = np.array(target_values)
-            feature_matrix = np.array(feature_matrix)
+            # Sample positions among the remembered experiences, oldest first
+            episode_positions = random.sample(range(number_remembered),
+                                              min(self._episode_size, number_remembered))
+            episode_slots = (oldest_slot + np.array(episode_positions)) % self._number_experiences_remembered
 
             parameters = self._parameter_vector()
-            nabla_error = 2 * np.dot(feature_matrix.T, np.dot(feature_matrix, parameters) - target_values)
+            feature_matrix = self._last_features[episode_slots]
+            target_values = np.dot(self._next_features[episode_slots], parameters) + self._rewards[episode_slots]
 
-            delta_parameter_vector = - self._alpha * nabla_error
-            new_parameter_vector = parameters + delta_parameter_vector
+            # The gradient of the squared error is 2 * F^T (F p - t)
+            residuals = np.dot(feature_matrix, parameters)
+            residuals -= target_values
+            nabla_error = np.dot(feature_matrix.T, residuals)
+
+            new_parameter_vector = parameters - (2 * self._alpha) * nabla_error
             self._set_parameter_vector(new_parameter_vector)
 
         self._last_afterstate_value = self._next_afterstate_value
         self._last_afterstate_matrix = self._next_afterstate_matrix
 
-    def _features(self, grid_matrix):
+    def _compute_features(self, grid_matrix):
         """Return feature vector.
 
         Args:
@@ -422,25 +560,12 @@ class AdvancedFeaturePlayer(AfterStatePlayer):
         # our colour and none of the other player's colour (N=1,...,4).
         # Also include those 4 numbers from the opponent's perspective.
         # Try to normalize each feature so its magnitude is about 1
-        multiplier = np.array([0.05, 0.2, 0.8, 1])
-        our_openings = connectfourutils.count_open_positions(grid_matrix, self._player_colour)[1:] * multiplier
-        opponents_openings = connectfourutils.count_open_positions(grid_matrix, self._other_colour)[1:] * multiplier
-
-        return np.concatenate([our_openings, opponents_openings])
-
-    def _state_value(self, grid_matrix):
-        """The estimated value of the given state matrix.
-
+        our_openings, opponents_openings = connectfourutils.count_open_positions_both(
+            grid_matrix, self._player_colour)
+        features = np.concatenate([our_openings[1:], opponents_openings[1:]])
+        features *= self._FEATURE_MULTIPLIER
 
-        Args:
-            grid_matrix (np.array): The Connect Four grid as a matrix (as defined in connectfour.py)
-
-        Returns:
-            Estimated value of the state corresponding to the input matrix.
-        """
-        features = self._features(grid_matrix)
-        parameter_vector = self._parameter_vector()
-        return np.dot(features, parameter_vector)
+        return features
 
     def _parameter_vector(self):
         """Return the parameter vector.
@@ -459,18 +584,6 @@ class AdvancedFeaturePlayer(AfterStatePlayer):
         """
         self._parameters = new_vector
 
-    def _nabla_parameter_vector(self, grid_matrix):
-        """Nabla of state value func with respect to parameter vector in the
-        state defined by grid_matrix.
-
-        Args:
-            grid_matrix (np.array): The state point in which to calculate nabla.
-
-        Returns:
-            np.array. Nabla of state grid_matrix with respect to parameter vector.
-        """
-        return self._features(grid_matrix)
-
 
 def test_simplefeatureplayer():
     """Run match of 2 SimpleFeaturePlayer() instances"""
@@ -488,9 +601,105 @@ def test_advancedfeatureplayer():
     match = connectfourgame.ConnectFourMatch(player_white, player_red)
     match.play()
 
+def test_caches_across_matches():
+    """Test that the feature cache outlives matches but not a change of colour"""
+    import connectfourgame
+    player = SimpleFeaturePlayer()
+    for _ in range(2):
+        match = connectfourgame.ConnectFourMatch(player, RandomPlayer())
+        match.play()
+        assert len(player._feature_cache) > 0
+
+    match = connectfourgame.ConnectFourMatch(RandomPlayer(), player)
+    assert len(player._feature_cache) == 0
+
+def test_least_recently_used_cache():
+    """Test that the least recently used entry is dropped when full"""
+    cache = _LeastRecentlyUsedCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c'), len(cache)) == (1, 3, 2)
+
+def test_merge_trained_copies():
+    """Test that merging copies averages their parameters"""
+    import copy
+    import connectfourgame
+    player = AdvancedFeaturePlayer()
+    player_copies = [copy.deepcopy(player) for _ in range(3)]
+    for player_copy in player_copies:
+        match = connectfourgame.ConnectFourMatch(player_copy, RandomPlayer())
+        for _ in range(10):
+            match.play()
+
+    assert all(len(player_copy._feature_cache) > 0 for player_copy in player_copies)
+    assert len(copy.deepcopy(player_copies[0])._feature_cache) == 0
+
+    player.merge_trained_copies(player_copies)
+    expected_parameters = sum(player_copy._parameter_vector() for player_copy in player_copies) / 3
+    assert np.allclose(player._parameter_vector(), expected_parameters)
+
+def test_feature_cache():
+    """Test that remembered features are those of the grid and colour"""
+    player = AdvancedFeaturePlayer()
+    player.set_player_colour(connectfour.WHITE)
+    game = connectfour.ConnectFour()
+    game.add_disc(3, connectfour.WHITE)
+    grid_matrix = game.grid_copy()
+
+    white_features = player._cached_features(grid_matrix)
+    assert player._cached_features(grid_matrix.copy()) is white_features
+    assert not white_features.flags.writeable
+
+    # From red's side the same grid has the halves swapped
+    player.set_player_colour(connectfour.RED)
+    red_features = player._cached_features(grid_matrix)
+    assert all(red_features == np.concatenate([white_features[4:], white_features[:4]]))
+
+def test_afterstate_values():
+    """Test that afterstates valued together get the values of _state_value"""
+    player = SimpleFeaturePlayer()
+    player.set_player_colour(connectfour.RED)
+    game = connectfour.ConnectFour()
+    for column in [3, 3, 4, 2]:
+        game.add_disc(column, connectfour.WHITE)
+
+    grid_matrix = game.grid_copy()
+    heights = [0, 0, 1, 2, 1, 0, 0]
+    afterstate_values = player._afterstate_values(grid_matrix, heights, game.legal_moves())
+    assert (grid_matrix == game.grid_copy()).all()
+
+    for move, afterstate_value in zip(game.legal_moves(), afterstate_values):
+        afterstate = game.clone()
+        afterstate.add_disc(move, connectfour.RED)
+        assert np.isclose(afterstate_value, player._state_value(afterstate.grid_copy()))
+
+def test_observe_grid():
+    """Test that the grid a player keeps up to date matches the game grid"""
+    player = SimpleFeaturePlayer()
+    for _ in range(20):
+        game = connectfour.ConnectFour()
+        colour = connectfour.WHITE
+        while game.legal_moves() and game.winner() is None:
+            # The player only looks at the grid every few moves
+            if random.random() < 0.4:
+                assert (player._observe_grid(game) == game.grid_copy()).all()
+            game.add_disc(random.choice(game.legal_moves()), colour)
+            colour = connectfour.other_colour(colour)
+
+        assert (player._observe_grid(game) == game.grid_copy()).all()
+
 def test():
     """Execute all tests for this module"""
     test_simplefeatureplayer()
+    test_caches_across_matches()
+    test_least_recently_used_cache()
+    test_merge_trained_copies()
+    test_feature_cache()
+    test_afterstate_values()
+    test_observe_grid()
 
 if __name__ == '__main__':
     test()
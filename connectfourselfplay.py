@@ -0,0 +1,301 @@
+"""Fast self-play between random players.
+
+Functions:
+    is_random_match: Check whether a match can be played without its players.
+    play_random_match: Play out a game with random moves.
+    play_random_matches: Play many matches between two random players at once,
+        optionally from a given position.
+    rollout_many: Count the results of many random play-outs of a position.
+"""
+import random
+import numpy as np
+import connectfour
+import connectfourplayers
+
+# Each match is stored as one bitboard per colour with the layout of
+# connectfour.ConnectFour.bitboards.
+_COLUMN_MASK = (1 << connectfour.BITS_PER_COLUMN) - 1
+
+# connectfour.CELL_LINES as an array, each row padded with masks of the
+# never set sentinel bit of column 0 so that the padding never completes.
+_MAX_CELL_LINES = max(len(lines) for lines in connectfour.CELL_LINES)
+_PADDED_CELL_LINES = np.array([lines + (1 << connectfour.ROWS,) * (_MAX_CELL_LINES - len(lines))
+                               for lines in connectfour.CELL_LINES], dtype=np.uint64)
+
+def _has_win_batch(bitboards, bit_numbers):
+    """Check which bitboards contain four in a row through the given cells.
+
+    Args:
+        bitboards (np.array): 1-dimensional array of bitboards (np.uint64)
+        bit_numbers (np.array): For each bitboard, the bit number of the cell
+            whose lines to check
+
+    Returns:
+        np.array of booleans, True where the bitboard has four discs in a line
+        through its cell.
+    """
+    lines = _PADDED_CELL_LINES[bit_numbers]
+    return ((bitboards[:, np.newaxis] & lines) == lines).any(axis=1)
+
+def is_random_match(player_white, player_red):
+    """Check whether a match between the players can be played without them.
+
+    Random players ignore rewards, keep no state and never make illegal
+    moves, so their matches can be played by play_random_match and
+    play_random_matches instead. Subclasses of RandomPlayer may change
+    that, so they do not count.
+
+    Args:
+        player_white: The player object playing white
+        player_red: The player object playing red
+
+    Returns:
+        True if both players are exactly RandomPlayer instances.
+    """
+    return (type(player_white) is connectfourplayers.RandomPlayer
+            and type(player_red) is connectfourplayers.RandomPlayer)
+
+def play_random_match(game=None, colour=connectfour.WHITE):
+    """Play out a game with random legal moves by both players.
+
+    This is a random match without the players and the match structure
+    around it, so it is suited for rollouts from positions met in a search.
+
+    Args:
+        game: ConnectFour() position to play out from. It is not modified. If
+            None, the game starts from the empty grid.
+        colour: The colour of the disc to be added first
+
+    Returns:
+        Colour of the winner (RED/WHITE) or None in case of a draw.
+    """
+    if game is None:
+        game = connectfour.ConnectFour()
+    if game.winner() is not None:
+        return game.winner()
+
+    # The play-out works on the bitboards directly rather than through game
+    white, red = game.bitboards()
+    if colour == connectfour.WHITE:
+        bitboard, other_bitboard = white, red
+    else:
+        bitboard, other_bitboard = red, white
+
+    occupied = white | red
+    heights = [(occupied >> (column * connectfour.BITS_PER_COLUMN) & _COLUMN_MASK).bit_length()
+               for column in range(connectfour.COLUMNS)]
+    legal_moves = [column for column, height in enumerate(heights) if height < connectfour.ROWS]
+
+    while legal_moves:
+        column = random.choice(legal_moves)
+        row = heights[column]
+        heights[column] = row + 1
+        if row + 1 == connectfour.ROWS:
+            legal_moves.remove(column)
+
+        bit_number = column * connectfour.BITS_PER_COLUMN + row
+        bitboard |= 1 << bit_number
+        # Only lines through the new disc can have been completed by it
+        for line in connectfour.CELL_LINES[bit_number]:
+            if bitboard & line == line:
+                return colour
+
+        bitboard, other_bitboard = other_bitboard, bitboard
+        colour = connectfour.other_colour(colour)
+
+    return None
+
+def play_random_matches(number_of_matches, rng=None, game=None, colour=connectfour.WHITE):
+    """Play matches between two random players, all at once.
+
+    Every ply is made in all unfinished matches by a handful of NumPy
+    operations, so the interpreter overhead is shared by all the matches. Each
+    match plays out like ConnectFourMatch(RandomPlayer(), RandomPlayer()).play().
+    Given a position, this doubles as a batch of rollouts from it.
+
+    Args:
+        number_of_matches: Number of matches to play
+        rng (np.random.Generator): Source of the random moves. If None, a new
+            generator is used.
+        game: ConnectFour() position to play all the matches from. It is not
+            modified. If None, the matches start from the empty grid.
+        colour: The colour of the disc to be added first
+
+    Returns:
+        np.array of length number_of_matches with the colour of the winner of
+        each match (WHITE or RED) or EMPTY in case of a draw.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if game is None:
+        game = connectfour.ConnectFour()
+    if game.winner() is not None:
+        return np.full(number_of_matches, game.winner(), dtype='i1')
+
+    white, red = game.bitboards()
+    occupied = white | red
+    bitboards = {connectfour.WHITE: np.full(number_of_matches, white, dtype=np.uint64),
+                 connectfour.RED: np.full(number_of_matches, red, dtype=np.uint64)}
+    heights = np.empty((number_of_matches, connectfour.COLUMNS), dtype=np.int64)
+    heights[:] = [(occupied >> (column * connectfour.BITS_PER_COLUMN) & _COLUMN_MASK).bit_length()
+                  for column in range(connectfour.COLUMNS)]
+    winners = np.full(number_of_matches, connectfour.EMPTY, dtype='i1')
+    unfinished = np.arange(number_of_matches)
+
+    for _move_number in range(connectfour.ROWS * connectfour.COLUMNS - occupied.bit_count()):
+        if unfinished.size == 0:
+            break
+
+        # A uniformly random legal column is the one with the largest random key
+        # once the keys of full columns are pushed below all the others.
+        unfinished_heights = heights[unfinished]
+        keys = rng.random(unfinished_heights.shape)
+        keys[unfinished_heights == connectfour.ROWS] = -1
+        columns = keys.argmax(axis=1)
+        rows = unfinished_heights[np.arange(unfinished.size), columns]
+
+        heights[unfinished, columns] += 1
+        bit_numbers = columns * connectfour.BITS_PER_COLUMN + rows
+        colour_bitboards = bitboards[colour][unfinished] | np.uint64(1) << bit_numbers.astype(np.uint64)
+        bitboards[colour][unfinished] = colour_bitboards
+
+        won = _has_win_batch(colour_bitboards, bit_numbers)
+        winners[unfinished[won]] = colour
+        unfinished = unfinished[~won]
+
+        colour = connectfour.other_colour(colour)
+
+    return winners
+
+def rollout_many(game, number_of_rollouts, colour):
+    """Play out a position many times with random moves by both sides.
+
+    The rollouts are played all at once (see play_random_matches), so a
+    search-based player can afford many of them per move.
+
+    Args:
+        game: ConnectFour() position to play out from. It is not modified.
+        number_of_rollouts: Number of random play-outs
+        colour: The colour of the disc to be added first
+
+    Returns:
+        Dictionary with the number of rollouts won by WHITE and RED and
+        drawn (None).
+    """
+    winners = play_random_matches(number_of_rollouts, game=game, colour=colour)
+    return {connectfour.WHITE: int((winners == connectfour.WHITE).sum()),
+            connectfour.RED: int((winners == connectfour.RED).sum()),
+            None: int((winners == connectfour.EMPTY).sum())}
+
+def test_play_random_match():
+    """Test random play-outs from the empty grid and from a finished game"""
+    winners = [play_random_match() for _ in range(2000)]
+    assert set(winners) <= {connectfour.WHITE, connectfour.RED, None}
+    assert winners.count(connectfour.WHITE) > winners.count(connectfour.RED) > 0
+
+    # White has four in the bottom row, so the game is decided already
+    game = connectfour.ConnectFour()
+    for column, colour in [(0, connectfour.WHITE), (0, connectfour.RED), (1, connectfour.WHITE),
+                           (1, connectfour.RED), (2, connectfour.WHITE), (2, connectfour.RED),
+                           (3, connectfour.WHITE)]:
+        game.add_disc(column, colour)
+    state_id = game.state_identifier()
+
+    assert play_random_match(game, connectfour.RED) == connectfour.WHITE
+    assert game.state_identifier() == state_id
+
+def test_play_random_matches():
+    """Test that batched random matches end in a win or a draw"""
+    winners = play_random_matches(2000)
+    assert winners.shape == (2000,)
+    assert set(winners) <= {connectfour.WHITE, connectfour.RED, connectfour.EMPTY}
+
+    # White wins most random matches but both colours win some
+    assert (winners == connectfour.WHITE).sum() > (winners == connectfour.RED).sum() > 0
+
+def test_play_random_matches_from_position():
+    """Test batched random matches from a given position"""
+    # White has four in the bottom row, so the game is decided already
+    game = connectfour.ConnectFour()
+    for column, colour in [(0, connectfour.WHITE), (0, connectfour.RED), (1, connectfour.WHITE),
+                           (1, connectfour.RED), (2, connectfour.WHITE), (2, connectfour.RED),
+                           (3, connectfour.WHITE)]:
+        game.add_disc(column, colour)
+    assert (play_random_matches(10, game=game, colour=connectfour.RED) == connectfour.WHITE).all()
+
+    # Discs alternate up each column, shifted by one row from column 3 on and
+    # back again in column 6. Only the top of column 6 is left and the last
+    # disc (red) fills the grid without four in a line.
+    game = connectfour.ConnectFour()
+    for column in range(connectfour.COLUMNS):
+        shift = 1 if 3 <= column <= 5 else 0
+        for row in range(connectfour.ROWS):
+            if (column, row) != (6, connectfour.ROWS - 1):
+                colour = (connectfour.WHITE, connectfour.RED)[(row + shift) % 2]
+                game.add_disc(column, colour)
+    state_id = game.state_identifier()
+
+    assert game.winner() is None
+    assert (play_random_matches(10, game=game, colour=connectfour.RED) == connectfour.EMPTY).all()
+    assert game.state_identifier() == state_id
+
+def test_rollout_many():
+    """Test that rollouts agree with single random play-outs from the same position"""
+    game = connectfour.ConnectFour()
+    for column in [3, 3, 2, 4]:
+        game.add_disc(column, connectfour.WHITE)
+    state_id = game.state_identifier()
+
+    counts = rollout_many(game, 2000, connectfour.RED)
+    assert sum(counts.values()) == 2000
+    assert game.state_identifier() == state_id
+
+    single_winners = [play_random_match(game, connectfour.RED) for _ in range(2000)]
+    for colour in [connectfour.WHITE, connectfour.RED]:
+        assert abs(counts[colour] - single_winners.count(colour)) < 200
+
+def test_has_win_batch():
+    """Test the batched win check against ConnectFour on random end positions"""
+    bitboards = []
+    bit_numbers = []
+    expected_wins = []
+    for _ in range(200):
+        game = connectfour.ConnectFour()
+        heights = [0] * connectfour.COLUMNS
+        colour = connectfour.WHITE
+        while game.legal_moves() and game.winner() is None:
+            column = random.choice(game.legal_moves())
+            game.add_disc(column, colour)
+            heights[column] += 1
+            colour = connectfour.other_colour(colour)
+
+        # The last disc added decided the game, if it was decided
+        last_colour = connectfour.other_colour(colour)
+        bitboards.append(game.bitboards()[0 if last_colour == connectfour.WHITE else 1])
+        bit_numbers.append(column * connectfour.BITS_PER_COLUMN + heights[column] - 1)
+        expected_wins.append(game.winner() is not None)
+
+    won = _has_win_batch(np.array(bitboards, dtype=np.uint64), np.array(bit_numbers))
+    assert list(won) == expected_wins
+
+def test_is_random_match():
+    """Test that only matches between plain random players count as random"""
+    class SubclassedRandomPlayer(connectfourplayers.RandomPlayer):
+        """On the fly class that may behave differently"""
+
+    random_player = connectfourplayers.RandomPlayer()
+    assert is_random_match(random_player, connectfourplayers.RandomPlayer())
+    assert not is_random_match(random_player, SubclassedRandomPlayer())
+    assert not is_random_match(connectfourplayers.SimpleFeaturePlayer(), random_player)
+
+def test():
+    """Execute all tests for this module"""
+    test_has_win_batch()
+    test_is_random_match()
+    test_play_random_match()
+    test_play_random_matches()
+    test_play_random_matches_from_position()
+    test_rollout_many()
+
+if __name__ == '__main__':
+    test()
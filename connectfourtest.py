@@ -2,13 +2,19 @@
 
 import connectfour
 import connectfourgame
+import connectfourmain
 import connectfourplayers
+import connectfourselfplay
+import connectfourutils
 
 def full_test():
     """Run all tests for Connect Four"""
     connectfour.test()
     connectfourgame.test()
+    connectfourmain.test()
     connectfourplayers.test()
+    connectfourselfplay.test()
+    connectfourutils.test()
 
 if __name__ == '__main__':
     full_test()
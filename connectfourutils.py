@@ -1,24 +1,66 @@
 """Functions related to Connect Four"""
 
+import itertools
 import numpy as np
 import connectfour
 
-def _count_element(array, element):
-    """Count occurrences of element in array.
+# A line of 4 is identified by its cells c0, ..., c3 as the code
+# c0 + 3*c1 + 9*c2 + 27*c3 (cells are EMPTY, WHITE or RED, that is 0, 1 or 2)
+_LINE_CODE_WEIGHTS = np.array([1, 3, 9, 27])
+
+def _line_buckets(player_colour):
+    """Table from line code to the bucket of count_open_positions it falls in.
+
+    Args:
+        player_colour: The colour belonging to the player (RED or WHITE)
+
+    Returns:
+        np.array of shape (81). Entry code is the number of discs of
+        player_colour on the line, or 5 if the other colour has a disc on it.
+    """
+    other_colour = connectfour.other_colour(player_colour)
+    line_buckets = np.empty(81, dtype=np.intp)
+    for cells in itertools.product([connectfour.EMPTY, connectfour.WHITE, connectfour.RED], repeat=4):
+        line_code = int(np.dot(cells, _LINE_CODE_WEIGHTS))
+        line_buckets[line_code] = 5 if other_colour in cells else cells.count(player_colour)
+
+    return line_buckets
+
+_LINE_BUCKETS = {connectfour.WHITE: _line_buckets(connectfour.WHITE),
+                 connectfour.RED: _line_buckets(connectfour.RED)}
+
+# Line indices per grid shape, see _line_indices
+_LINE_INDICES = {}
+
+def _line_indices(num_rows, num_cols):
+    """Indices of the cells of the lines of 4 in a flattened grid of given shape.
 
     Args:
-        array (np.array): 1-dimensional np.array
-        element: any object that can be in an np.array
+        num_rows: Number of rows of the grid
+        num_cols: Number of columns of the grid
 
     Returns:
-        How many times element occurs in array (int)
+        np.array of shape (number of lines, 4). Each row holds the indices of
+        one line (horizontal, vertical or diagonal).
     """
-    count = 0
-    for entry in array:
-        if entry == element:
-            count += 1
+    shape = (num_rows, num_cols)
+    if shape not in _LINE_INDICES:
+        line_indices = []
+        for row in range(num_rows):
+            for col in range(num_cols):
+                for direction in [(1, 0), (0, 1), (1, 1), (1, -1)]:
+                    # Do the four jumps exceed the grid boundaries? If so skip to next
+                    if (row + 3 * direction[0] >= num_rows or col + 3 * direction[1] >= num_cols
+                            or col + 3 * direction[1] < 0):
+                        continue
+
+                    start = row * num_cols + col
+                    jump = direction[0]*num_cols + direction[1]
+                    line_indices.append(range(start, start + 4 * jump, jump))
 
-    return count
+        _LINE_INDICES[shape] = np.array(line_indices)
+
+    return _LINE_INDICES[shape]
 
 def count_open_positions(game_grid, player_colour):
     """Count number of possible 4-in-a-row sequences bucketed by how many cells
@@ -34,14 +76,63 @@ def count_open_positions(game_grid, player_colour):
         vertical or diagonal) that have n discs of specified player colour and the rest
         empty.
     """
+    return count_open_positions_both(game_grid, player_colour)[0]
+
+def count_open_positions_both(game_grid, player_colour):
+    """Count open positions (see count_open_positions) for both colours at once.
+
+    The contents of each line are looked up once for both colours.
+
+    Args:
+        game_grid (np.array): a 2-dimensional array specifying the grid of Connect
+            Four. Entries must be RED, WHITE or EMPTY as defined in connectfour.py.
+        player_colour: The colour belonging to the player (RED or WHITE).
+
+    Returns:
+        Tuple of two np.arrays of shape (5) as returned by count_open_positions,
+        for player_colour and for the other colour.
+    """
     if player_colour == connectfour.RED:
         other_colour = connectfour.WHITE
     else:
         other_colour = connectfour.RED
 
-    counts = np.zeros(5)
+    line_codes = np.dot(game_grid.reshape(game_grid.size)[_line_indices(*game_grid.shape)],
+                        _LINE_CODE_WEIGHTS)
+
+    # Bucket 5 holds the lines blocked by the other colour
+    player_counts = np.bincount(_LINE_BUCKETS[player_colour][line_codes], minlength=6)[:5]
+    other_counts = np.bincount(_LINE_BUCKETS[other_colour][line_codes], minlength=6)[:5]
 
-    flat_game_grid = game_grid.reshape(game_grid.size)
+    return player_counts.astype(float), other_counts.astype(float)
+
+def test_count_open_positions():
+    """Test count_open_positions function"""
+
+    game_grid = np.full((4, 4), connectfour.EMPTY, dtype=np.int8)
+    assert all(count_open_positions(game_grid, connectfour.WHITE) == [10, 0, 0, 0, 0])
+    game_grid[0, 0] = connectfour.WHITE
+    assert all(count_open_positions(game_grid, connectfour.WHITE) == [7, 3, 0, 0, 0])
+    game_grid[0, 1] = connectfour.RED
+    assert all(count_open_positions(game_grid, connectfour.RED) == [6, 1, 0, 0, 0])
+    game_grid[:, 1] = np.full(4, connectfour.RED, dtype=np.int8)
+    assert all(count_open_positions(game_grid, connectfour.RED) == [2, 4, 0, 0, 1])
+
+def _count_open_positions_reference(game_grid, player_colour):
+    """Count open positions (see count_open_positions) cell by cell.
+
+    This is a plain scan of every line, kept to test the vectorised counting.
+
+    Args:
+        game_grid (np.array): a 2-dimensional array specifying the grid of Connect
+            Four. Entries must be RED, WHITE or EMPTY as defined in connectfour.py.
+        player_colour: The colour belonging to the player (RED or WHITE).
+
+    Returns:
+        List of 5 ints as the entries returned by count_open_positions.
+    """
+    other_colour = connectfour.other_colour(player_colour)
+    counts = [0] * 5
     num_rows, num_cols = game_grid.shape
 
     for row in range(num_rows):
@@ -52,36 +143,38 @@ def count_open_positions(game_grid, player_colour):
                         or col + 3 * direction[1] < 0):
                     continue
 
-                start = row * num_cols + col
-                jump = direction[0]*num_cols + direction[1]
-
-                indices = [index for index in range(start, start + 4 * jump, jump)
-                           if index >= 0 and index < game_grid.size]
-                entries = flat_game_grid[indices]
-
-                if other_colour in entries:
-                    continue
-                else:
-                    player_colour_count = _count_element(entries, player_colour)
-                    counts[player_colour_count] += 1
+                entries = [game_grid[row + step * direction[0], col + step * direction[1]]
+                           for step in range(4)]
+                if other_colour not in entries:
+                    counts[entries.count(player_colour)] += 1
 
     return counts
 
-def test_count_open_positions():
-    """Test count_open_positions function"""
-
-    game_grid = np.full((4, 4), connectfour.EMPTY, dtype=np.int)
-    assert all(count_open_positions(game_grid, connectfour.WHITE) == [10, 0, 0, 0, 0])
-    game_grid[0, 0] = connectfour.WHITE
-    assert all(count_open_positions(game_grid, connectfour.WHITE) == [7, 3, 0, 0, 0])
-    game_grid[0, 1] = connectfour.RED
-    assert all(count_open_positions(game_grid, connectfour.RED) == [6, 1, 0, 0, 0])
-    game_grid[:, 1] = np.full(4, connectfour.RED, dtype=np.int)
-    assert all(count_open_positions(game_grid, connectfour.RED) == [2, 4, 0, 0, 1])
+def test_count_open_positions_both():
+    """Test both colours' counts against the reference on random grids"""
+    rng = np.random.default_rng(2017)
+    game_grids = []
+    for shape in [(6, 7), (4, 4), (5, 6)]:
+        num_rows, num_cols = shape
+        for _ in range(100):
+            # Discs stacked from the bottom up to random heights, and full grids
+            game_grid = rng.choice([connectfour.WHITE, connectfour.RED], size=shape).astype(np.int8)
+            heights = rng.integers(0, num_rows + 1, size=num_cols)
+            game_grid[np.arange(num_rows)[:, np.newaxis] >= heights] = connectfour.EMPTY
+            game_grids.append(game_grid)
+            game_grids.append(rng.choice([connectfour.WHITE, connectfour.RED], size=shape).astype(np.int8))
+
+    for game_grid in game_grids:
+        for colour in [connectfour.WHITE, connectfour.RED]:
+            player_counts, other_counts = count_open_positions_both(game_grid, colour)
+            assert list(player_counts) == _count_open_positions_reference(game_grid, colour)
+            assert list(other_counts) == _count_open_positions_reference(
+                game_grid, connectfour.other_colour(colour))
 
 def test():
     """Run all tests"""
     test_count_open_positions()
+    test_count_open_positions_both()
 
 if __name__ == '__main__':
     test()